@@ -1,18 +1,51 @@
 import os
+import re
 import sys
 import csv
+import gzip
+import json
+import hashlib
+import mimetypes
+import urllib.request
+from io import BytesIO
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+import time
+import uuid
+import queue
+import atexit
 import logging
+import threading
+import shutil
 import subprocess
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from flask import Flask, render_template, request, jsonify
 import flask
-from flask_socketio import SocketIO, emit
-from typing import Dict, List, Optional, Any
+from flask_socketio import SocketIO, emit, ConnectionRefusedError
+from typing import Dict, List, Optional, Any, Callable
 from dataclasses import dataclass, asdict
-from threading import Lock
+from threading import Lock, Event
+import numpy as np
 import firebase_admin
 from firebase_admin import credentials, db, messaging
 
+try:
+    from eventlet import patcher as eventlet_patcher
+except ImportError:  # Without eventlet the stdlib threading/queue are already the real ones
+    eventlet_patcher = None
+
+try:
+    import brotli
+except ImportError:  # Optional: only gzip copies are generated without it
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # Optional: images are served unresized without it
+    Image = None
+
 # --- Configuration ---
 @dataclass
 class Config:
@@ -26,14 +59,177 @@ class Config:
     # New configuration for CSV logging
     LOGS_FOLDER: str = os.environ.get('LOGS_FOLDER', 'logs')
     CSV_FILENAME: str = os.environ.get('CSV_FILENAME', 'call_logs.csv')
+    # Closed months are compacted out of the CSV into columnar files here
+    ARCHIVE_FOLDER: str = os.environ.get('ARCHIVE_FOLDER', os.path.join(LOGS_FOLDER, 'archive'))
+    # Fingerprinted, precompressed copies of page assets are built here on startup
+    ASSET_BUILD_FOLDER: str = os.environ.get('ASSET_BUILD_FOLDER', 'static/build')
+    # Socket.IO heartbeat: a client missing a ping for interval + timeout seconds is dropped
+    SOCKET_PING_INTERVAL: int = int(os.environ.get('SOCKET_PING_INTERVAL', '15'))
+    SOCKET_PING_TIMEOUT: int = int(os.environ.get('SOCKET_PING_TIMEOUT', '10'))
+    # Max concurrent clients per role, as "role:limit,..."; roles not listed use "other"
+    SOCKET_CLIENT_LIMITS: str = os.environ.get('SOCKET_CLIENT_LIMITS', 'display:50,staff:30,other:20')
+    # Outbound packets queued for one client before broadcasts skip it / it is disconnected
+    SOCKET_DROP_BACKLOG: int = int(os.environ.get('SOCKET_DROP_BACKLOG', '10'))
+    SOCKET_EVICT_BACKLOG: int = int(os.environ.get('SOCKET_EVICT_BACKLOG', '50'))
+    # Live TV relay: displays fetch channels through the server instead of upstream
+    HLS_RELAY_ENABLED: bool = os.environ.get('HLS_RELAY_ENABLED', 'True').lower() == 'true'
+    HLS_CHANNEL_LIST: str = os.environ.get('HLS_CHANNEL_LIST', 'static/livetv.m3u8')
+    HLS_CACHE_MB: int = int(os.environ.get('HLS_CACHE_MB', '64'))
+    # Channels nobody has requested for this long have their cache dropped
+    HLS_IDLE_SECONDS: int = int(os.environ.get('HLS_IDLE_SECONDS', '60'))
+    HLS_UPSTREAM_TIMEOUT: int = int(os.environ.get('HLS_UPSTREAM_TIMEOUT', '10'))
+    # Numbers after the called one that get an "almost your turn" push (0 disables)
+    NOTIFY_LOOKAHEAD: int = int(os.environ.get('NOTIFY_LOOKAHEAD', '3'))
+    # Application log output ('json' or 'text'), written by a background thread
+    LOG_FORMAT: str = os.environ.get('LOG_FORMAT', 'json').lower()
+    LOG_QUEUE_SIZE: int = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+    # Max INFO records per message template per window (0 disables rate limiting)
+    LOG_RATE_LIMIT: int = int(os.environ.get('LOG_RATE_LIMIT', '30'))
+    LOG_RATE_WINDOW: float = float(os.environ.get('LOG_RATE_WINDOW', '60'))
 
 config = Config()
 
 # --- Logging Setup ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# gunicorn's eventlet worker monkey-patches threading and queue into green versions.
+# The log writer must be a real OS thread so a blocked stderr/journald write
+# stalls only that thread, never the event loop handling calls.
+_os_threading = eventlet_patcher.original('threading') if eventlet_patcher else threading
+_os_queue = eventlet_patcher.original('queue') if eventlet_patcher else queue
+
+# Correlation ID of the call currently being processed ('-' outside a call)
+call_id_var: ContextVar[str] = ContextVar('call_id', default='-')
+
+_STANDARD_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'call_id', 'suppressed'}
+
+class CallContextFilter(logging.Filter):
+    """Stamp each record with the correlation ID of the current call."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.call_id = call_id_var.get()
+        return True
+
+class RateLimitFilter(logging.Filter):
+    """Allow at most `limit` INFO-or-lower records per message template per window.
+
+    Warnings and errors always pass. The first record let through after a
+    window in which records were dropped carries a `suppressed` count.
+    """
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._windows: Dict[tuple, List[float]] = {}
+        self._lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0 or record.levelno > logging.INFO:
+            return True
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            # [window_start, passed, suppressed]
+            state = self._windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                if state is not None and state[2]:
+                    record.suppressed = int(state[2])
+                state = [now, 0, 0]
+                self._windows[key] = state
+            if state[1] >= self.limit:
+                state[2] += 1
+                return False
+            state[1] += 1
+            return True
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hand records to the background writer without formatting or blocking.
+
+    Messages keep their %-style args so formatting happens on the writer
+    thread. If the queue is full the record is dropped and counted.
+    """
+    def __init__(self, log_queue: Any):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except _os_queue.Full:
+            self.dropped += 1
+
+class OSThreadQueueListener(QueueListener):
+    """QueueListener whose writer is always a real OS thread, even under eventlet."""
+    def __init__(self, log_queue: Any, *handlers: logging.Handler, respect_handler_level: bool = False):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.running = False
+
+    def start(self) -> None:
+        self._thread = _os_threading.Thread(target=self._monitor, name='log-writer', daemon=True)
+        self._thread.start()
+        self.running = True
+
+    def enqueue_sentinel(self) -> None:
+        # Blocks until the writer makes room, so a full queue can't lose the stop signal
+        self.queue.put(self._sentinel)
+
+    def stop(self) -> None:
+        """Drain the queue and stop the writer thread (safe to call twice)."""
+        if self.running:
+            self.running = False
+            super().stop()
+
+class JsonFormatter(logging.Formatter):
+    """Render records as one JSON object per line."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'call_id': getattr(record, 'call_id', '-'),
+            'msg': record.getMessage(),
+        }
+        # Structured fields passed via `extra=`
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_ATTRS:
+                entry[key] = value
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging() -> tuple[NonBlockingQueueHandler, OSThreadQueueListener]:
+    """Route all logging through a bounded queue drained by a background OS thread."""
+    stream_handler = logging.StreamHandler()
+    if config.LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(call_id)s] %(message)s'
+        ))
+
+    log_queue = _os_queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(CallContextFilter())
+    queue_handler.addFilter(RateLimitFilter(config.LOG_RATE_LIMIT, config.LOG_RATE_WINDOW))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.INFO)
+
+    listener = OSThreadQueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return queue_handler, listener
+
+log_handler, log_listener = setup_logging()
+
+def flush_logging() -> None:
+    """Drain the log queue and stop the writer thread (safe to call twice)."""
+    log_listener.stop()
+
+atexit.register(flush_logging)
 logger = logging.getLogger(__name__)
 
 # --- Firebase Setup ---
@@ -67,6 +263,9 @@ class CSVLogger:
         self.csv_filename = csv_filename
         self.csv_path = os.path.join(logs_folder, csv_filename)
         self._lock = Lock()
+        # Called with the new month (YYYY-MM) when the first call of a month is logged
+        self.on_new_month: Optional[Callable[[str], None]] = None
+        self._month = datetime.now().strftime('%Y-%m')
         self._ensure_logs_directory()
         self._ensure_csv_headers()
     
@@ -118,14 +317,20 @@ class CSVLogger:
                     writer = csv.writer(csvfile)
                     writer.writerow(row_data)
                 
-                logger.info(f"Logged call to CSV: {call.number} at {call.counter} on {timestamp_str}")
-                return True
+                logger.info("Logged call to CSV: %s at %s on %s", call.number, call.counter, timestamp_str)
+                new_month = date_str[:7] if date_str[:7] > self._month else None
+                if new_month:
+                    self._month = new_month
+
+            if new_month and self.on_new_month:
+                self.on_new_month(new_month)
+            return True
                 
         except (OSError, IOError) as e:
-            logger.error(f"Failed to log call to CSV: {e}")
+            logger.error("Failed to log call to CSV: %s", e)
             return False
         except Exception as e:
-            logger.error(f"Unexpected error logging call to CSV: {e}")
+            logger.error("Unexpected error logging call to CSV: %s", e)
             return False
     
     def get_recent_calls(self, limit: int = 10) -> List[Dict[str, Any]]:
@@ -188,13 +393,292 @@ class CSVLogger:
             logger.error(f"Unexpected error reading calls by date: {e}")
             return []
 
+    def get_all_calls(self) -> List[Dict[str, Any]]:
+        """Get every call still in the live CSV file."""
+        try:
+            if not os.path.exists(self.csv_path):
+                return []
+
+            with open(self.csv_path, 'r', newline='', encoding='utf-8') as csvfile:
+                return list(csv.DictReader(csvfile))
+
+        except (OSError, IOError) as e:
+            logger.error("Failed to read calls from CSV: %s", e)
+            return []
+
+    def archive_closed_months(self, archive: 'CallArchive', current_month: str) -> int:
+        """Move rows from months before current_month (YYYY-MM) into the archive. Thread-safe."""
+        with self._lock:
+            if not os.path.exists(self.csv_path):
+                return 0
+
+            with open(self.csv_path, 'r', newline='', encoding='utf-8') as csvfile:
+                reader = csv.DictReader(csvfile)
+                fieldnames = reader.fieldnames
+                rows = list(reader)
+
+            closed: Dict[str, List[Dict[str, str]]] = {}
+            live = []
+            malformed = 0
+            for row in rows:
+                if not CallArchive.is_valid_row(row):
+                    # Left in the live CSV untouched rather than archived or lost
+                    malformed += 1
+                    live.append(row)
+                    continue
+                month = row['timestamp'][:7]
+                if month < current_month:
+                    closed.setdefault(month, []).append(row)
+                else:
+                    live.append(row)
+
+            if malformed:
+                logger.warning("Skipped %d malformed rows in %s", malformed, self.csv_path)
+            if not closed:
+                return 0
+
+            # Archive first: a crash before the CSV rewrite leaves the rows in
+            # both places, and the next run's merge skips the ones already archived
+            for month, month_rows in sorted(closed.items()):
+                archive.append_month(month, month_rows)
+
+            tmp_path = self.csv_path + '.tmp'
+            with open(tmp_path, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(live)
+            os.replace(tmp_path, self.csv_path)
+
+            archived = len(rows) - len(live)
+            logger.info("Archived %d calls from %d closed months", archived, len(closed))
+            return archived
+
+# --- Columnar Call Archive ---
+class CallArchive:
+    """
+    Closed months of the call log in a compact columnar form.
+
+    Each month is two files in the archive folder:
+      YYYY-MM.npy   packed records (ts uint32, counter uint8, number uint16),
+                    ts being local wall-clock seconds since 1970-01-01
+      YYYY-MM.json  the counter and number dictionaries the codes index into
+
+    Records are memory-mapped on read and queried with vectorized group-bys.
+    """
+    DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+    def __init__(self, archive_folder: str):
+        self.archive_folder = archive_folder
+        self._cache: Dict[str, Dict[str, Any]] = {}
+        self._lock = Lock()
+        os.makedirs(self.archive_folder, exist_ok=True)
+
+    @staticmethod
+    def is_valid_row(row: Dict[str, Optional[str]]) -> bool:
+        """Whether a CSV row has a parseable timestamp, number and counter (a truncated write does not)."""
+        try:
+            datetime.strptime(row.get('timestamp') or '', '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return False
+        return bool(row.get('number')) and bool(row.get('counter'))
+
+    @classmethod
+    def encode_rows(cls, rows: List[Dict[str, str]]) -> Dict[str, Any]:
+        """Encode CSV rows into timestamp/counter/number columns plus dictionaries, skipping malformed rows."""
+        valid = [row for row in rows if cls.is_valid_row(row)]
+        if len(valid) < len(rows):
+            logger.warning("Skipped %d malformed call log rows", len(rows) - len(valid))
+            rows = valid
+        ts = np.array([row['timestamp'] for row in rows], dtype='datetime64[s]').astype(np.int64)
+        counters, counter_codes = np.unique([row['counter'] for row in rows], return_inverse=True)
+        numbers, number_codes = np.unique([row['number'] for row in rows], return_inverse=True)
+        return {
+            'ts': ts.astype(np.uint32),
+            'counter': counter_codes.astype(np.uint8 if len(counters) <= 256 else np.uint16),
+            'number': number_codes.astype(np.uint16 if len(numbers) <= 65536 else np.uint32),
+            'counters': counters.tolist(),
+            'numbers': numbers.tolist(),
+        }
+
+    def _paths(self, month: str) -> tuple[str, str]:
+        base = os.path.join(self.archive_folder, month)
+        return base + '.npy', base + '.json'
+
+    def months(self) -> List[str]:
+        """List archived months (YYYY-MM), oldest first."""
+        return sorted(
+            name[:-4] for name in os.listdir(self.archive_folder)
+            if name.endswith('.npy') and len(name) == 11
+        )
+
+    def append_month(self, month: str, rows: List[Dict[str, str]]) -> None:
+        """Write rows for a month, merging with anything already archived for it."""
+        # Read without mmap so no file handle stays open on the file being replaced
+        existing = self._read_month(month, mmap_mode=None)
+        if existing is not None:
+            archived_rows = self.decode(existing)
+            # Rows already archived by an interrupted earlier run are not added twice
+            archived = {(row['timestamp'], row['number'], row['counter']) for row in archived_rows}
+            rows = archived_rows + [
+                row for row in rows
+                if (row['timestamp'], row['number'], row['counter']) not in archived
+            ]
+        rows.sort(key=lambda row: row['timestamp'])
+        columns = self.encode_rows(rows)
+
+        records = np.empty(len(columns['ts']), dtype=[
+            ('ts', columns['ts'].dtype),
+            ('counter', columns['counter'].dtype),
+            ('number', columns['number'].dtype),
+        ])
+        for name in ('ts', 'counter', 'number'):
+            records[name] = columns[name]
+
+        npy_path, json_path = self._paths(month)
+        with open(json_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'counters': columns['counters'], 'numbers': columns['numbers']}, f)
+        with open(npy_path + '.tmp', 'wb') as f:
+            np.save(f, records)
+
+        with self._lock:
+            self._cache.pop(month, None)
+            os.replace(json_path + '.tmp', json_path)
+            os.replace(npy_path + '.tmp', npy_path)
+
+    def _read_month(self, month: str, mmap_mode: Optional[str] = 'r') -> Optional[Dict[str, Any]]:
+        npy_path, json_path = self._paths(month)
+        if not os.path.exists(npy_path):
+            return None
+
+        records = np.load(npy_path, mmap_mode=mmap_mode)
+        with open(json_path, 'r', encoding='utf-8') as f:
+            columns: Dict[str, Any] = json.load(f)
+        for name in ('ts', 'counter', 'number'):
+            columns[name] = records[name]
+        return columns
+
+    def load_month(self, month: str) -> Optional[Dict[str, Any]]:
+        """Memory-map a month's columns, or None if it is not archived."""
+        with self._lock:
+            if month not in self._cache:
+                columns = self._read_month(month)
+                if columns is None:
+                    return None
+                self._cache[month] = columns
+            return self._cache[month]
+
+    @classmethod
+    def decode(cls, columns: Dict[str, Any], mask: Optional[Any] = None) -> List[Dict[str, str]]:
+        """Expand (optionally masked) columns back into CSV-shaped rows."""
+        ts = np.asarray(columns['ts'])
+        counter_codes = np.asarray(columns['counter'])
+        number_codes = np.asarray(columns['number'])
+        if mask is not None:
+            ts, counter_codes, number_codes = ts[mask], counter_codes[mask], number_codes[mask]
+
+        # ISO strings look like 'YYYY-MM-DDTHH:MM:SS'
+        stamps = ts.astype(np.int64).astype('datetime64[s]').astype(str).tolist()
+        weekdays = ((ts.astype(np.int64) // 86400 + 3) % 7).tolist()
+        numbers = columns['numbers']
+        counters = columns['counters']
+        return [
+            {
+                'timestamp': stamp.replace('T', ' '),
+                'date': stamp[:10],
+                'time': stamp[11:],
+                'number': numbers[number_code],
+                'counter': counters[counter_code],
+                'day_of_week': cls.DAY_NAMES[weekday],
+            }
+            for stamp, weekday, number_code, counter_code
+            in zip(stamps, weekdays, number_codes.tolist(), counter_codes.tolist())
+        ]
+
+    def get_calls_by_date(self, target_date: str) -> List[Dict[str, str]]:
+        """Get all archived calls for a specific date (YYYY-MM-DD format)."""
+        columns = self.load_month(target_date[:7])
+        if columns is None:
+            return []
+        day_start = int(np.datetime64(target_date, 's').astype(np.int64))
+        # Rows are stored in time order, so the day is a contiguous slice
+        start, end = np.searchsorted(columns['ts'], [day_start, day_start + 86400])
+        return self.decode(columns, slice(int(start), int(end)))
+
+    def _iter_columns(self, start_month: str, end_month: str, live_rows: List[Dict[str, str]]):
+        """Yield columns for archived months in range, then for live rows in range."""
+        for month in self.months():
+            if start_month <= month <= end_month:
+                columns = self.load_month(month)
+                if columns is not None:
+                    yield month, columns
+        live_rows = [row for row in live_rows if start_month <= (row['timestamp'] or '')[:7] <= end_month]
+        if live_rows:
+            yield None, self.encode_rows(live_rows)
+
+    def heatmap(self, start_month: str, end_month: str, live_rows: List[Dict[str, str]]) -> List[List[int]]:
+        """Call counts as a 7x24 matrix of [weekday (Monday=0)][hour]."""
+        counts = np.zeros(7 * 24, dtype=np.int64)
+        for _, columns in self._iter_columns(start_month, end_month, live_rows):
+            ts = np.asarray(columns['ts'], dtype=np.int64)
+            # 1970-01-01 was a Thursday (weekday 3)
+            weekday = (ts // 86400 + 3) % 7
+            hour = (ts // 3600) % 24
+            counts += np.bincount(weekday * 24 + hour, minlength=7 * 24)
+        return counts.reshape(7, 24).tolist()
+
+    def monthly_totals(self, start_month: str, end_month: str, live_rows: List[Dict[str, str]]) -> Dict[str, Dict[str, Any]]:
+        """Total calls and per-counter usage for each month in range."""
+        totals: Dict[str, Dict[str, Any]] = {}
+        for month, columns in self._iter_columns(start_month, end_month, live_rows):
+            if month is None:
+                # Live rows may span months if compaction has not run yet
+                ts = np.asarray(columns['ts'], dtype=np.int64)
+                month_keys = ts.astype('datetime64[s]').astype('datetime64[M]').astype(str)
+                for live_month in np.unique(month_keys).tolist():
+                    mask = month_keys == live_month
+                    totals[live_month] = self._summarize(columns, mask, totals.get(live_month))
+            else:
+                totals[month] = self._summarize(columns, None, totals.get(month))
+        return dict(sorted(totals.items()))
+
+    @staticmethod
+    def _summarize(columns: Dict[str, Any], mask: Optional[np.ndarray], into: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        codes = np.asarray(columns['counter'])
+        if mask is not None:
+            codes = codes[mask]
+        summary = into or {'total_calls': 0, 'counter_usage': {}}
+        summary['total_calls'] += int(codes.size)
+        for code, count in enumerate(np.bincount(codes, minlength=len(columns['counters'])).tolist()):
+            if count:
+                name = columns['counters'][code]
+                summary['counter_usage'][name] = summary['counter_usage'].get(name, 0) + count
+        return summary
+
 # --- Application Setup ---
 app = Flask(__name__, static_url_path='/static')
 app.config['SECRET_KEY'] = config.SECRET_KEY
-socketio = SocketIO(app, cors_allowed_origins=config.CORS_ORIGINS)
+socketio = SocketIO(
+    app,
+    cors_allowed_origins=config.CORS_ORIGINS,
+    ping_interval=config.SOCKET_PING_INTERVAL,
+    ping_timeout=config.SOCKET_PING_TIMEOUT
+)
 
-# Initialize CSV Logger
+# Initialize CSV Logger and the archive of closed months
 csv_logger = CSVLogger(config.LOGS_FOLDER, config.CSV_FILENAME)
+call_archive = CallArchive(config.ARCHIVE_FOLDER)
+
+def compact_call_log(current_month: Optional[str] = None) -> int:
+    """Roll months before current_month (default: this month) out of the live CSV."""
+    try:
+        return csv_logger.archive_closed_months(call_archive, current_month or datetime.now().strftime('%Y-%m'))
+    except Exception as e:
+        logger.error("Failed to compact call logs: %s", e)
+        return 0
+
+# Compact on every start (gunicorn never runs __main__) and whenever a new month begins
+compact_call_log()
+csv_logger.on_new_month = lambda month: socketio.start_background_task(compact_call_log, month)
 
 # --- Thread-Safe State Management ---
 class CallManager:
@@ -202,6 +686,9 @@ class CallManager:
         self.max_calls = max_calls
         self.call_history: List[Call] = []
         self.csv_logger = csv_logger
+        # Clients use (epoch, version) to order states across reconnects and restarts
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
         self._lock = Lock()
     
     def add_call(self, number: str, counter: str) -> Call:
@@ -211,13 +698,14 @@ class CallManager:
         with self._lock:
             self.call_history.insert(0, new_call)
             self.call_history = self.call_history[:self.max_calls]
-            logger.info(f"New call added: {number} at {counter}")
+            self.version += 1
+            logger.info("New call added: %s at %s", number, counter)
         
         # Log to CSV (outside the lock to avoid blocking)
         if self.csv_logger:
             success = self.csv_logger.log_call(new_call)
             if not success:
-                logger.warning(f"Failed to log call to CSV: {number} at {counter}")
+                logger.warning("Failed to log call to CSV: %s at %s", number, counter)
         
         return new_call
     
@@ -226,11 +714,80 @@ class CallManager:
         with self._lock:
             return {
                 "current": self.call_history[0].to_dict() if self.call_history else {},
-                "history": [call.to_dict() for call in self.call_history[1:]]
+                "history": [call.to_dict() for call in self.call_history[1:]],
+                "epoch": self.epoch,
+                "version": self.version
             }
 
 call_manager = CallManager(config.MAX_CALLS, csv_logger)
 
+# --- Socket Client Registry ---
+class ClientRegistry:
+    """Thread-safe record of connected Socket.IO clients by role."""
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        self._clients: Dict[str, str] = {}
+        self.rejected = 0
+        self.evicted = 0
+        self.dropped = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def parse_limits(spec: str) -> Dict[str, int]:
+        """Parse "display:50,staff:30" into a role -> limit mapping."""
+        limits = {}
+        for item in spec.split(','):
+            role, _, limit = item.partition(':')
+            if role.strip() and limit.strip():
+                limits[role.strip()] = int(limit)
+        limits.setdefault('other', 20)
+        return limits
+
+    def normalize_role(self, role: Optional[str]) -> str:
+        return role if role in self.limits else 'other'
+
+    def admit(self, sid: str, role: str) -> bool:
+        """Register a client unless its role is already at its limit."""
+        with self._lock:
+            connected = sum(1 for r in self._clients.values() if r == role)
+            if connected >= self.limits[role]:
+                self.rejected += 1
+                return False
+            self._clients[sid] = role
+            return True
+
+    def remove(self, sid: str) -> Optional[str]:
+        with self._lock:
+            return self._clients.pop(sid, None)
+
+    def record_evict(self) -> None:
+        with self._lock:
+            self.evicted += 1
+
+    def record_drop(self) -> None:
+        with self._lock:
+            self.dropped += 1
+
+    def sids(self) -> List[str]:
+        with self._lock:
+            return list(self._clients)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            connected = {role: 0 for role in self.limits}
+            for role in self._clients.values():
+                connected[role] += 1
+            return {
+                "connected": connected,
+                "limits": dict(self.limits),
+                "total": len(self._clients),
+                "rejected": self.rejected,
+                "evicted": self.evicted,
+                "dropped_broadcasts": self.dropped
+            }
+
+client_registry = ClientRegistry(ClientRegistry.parse_limits(config.SOCKET_CLIENT_LIMITS))
+
 # --- Media Management ---
 class MediaManager:
     def __init__(self, media_folder: str):
@@ -268,6 +825,430 @@ class MediaManager:
 
 media_manager = MediaManager(config.MEDIA_FOLDER)
 
+# --- Live TV (HLS) Relay ---
+class HlsRelayError(Exception):
+    """Raised when an upstream playlist or segment cannot be fetched."""
+
+class HlsUnknownResourceError(Exception):
+    """Raised for a channel or resource the relay has not seen in a playlist."""
+
+class HlsRelay:
+    """
+    Shared relay for the live TV channels.
+
+    Each upstream playlist and segment is fetched once no matter how many
+    displays are watching, kept in a short rolling in-memory cache, and
+    served from local /hls/ URLs. Channels nobody is watching are dropped.
+    """
+    USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36')
+    PLAYLIST_TYPE = 'application/vnd.apple.mpegurl'
+    # Known resource URLs per channel; older entries have long left the live window
+    MAX_RESOURCES = 500
+    READ_CHUNK = 64 * 1024
+
+    def __init__(self, max_cache_bytes: int, idle_seconds: int, timeout: int,
+                 fetch: Optional[Callable[[str], tuple[bytes, str, str]]] = None):
+        self.max_cache_bytes = max_cache_bytes
+        self.idle_seconds = idle_seconds
+        self.timeout = timeout
+        # urllib's timeout bounds each socket operation, not the whole download
+        self.deadline = 2 * timeout
+        # fetch(url) -> (body, content_type, final_url); swappable for a stand-in origin
+        self._fetch = fetch or self._http_fetch
+        # channel_id -> {'url', 'last_access', 'resources': OrderedDict[key, url]}
+        self._channels: Dict[str, Dict[str, Any]] = {}
+        # (channel_id, key) -> (expires_at, body, content_type)
+        self._cache: 'OrderedDict[tuple, tuple[float, bytes, str]]' = OrderedDict()
+        self._cache_bytes = 0
+        self._pending: Dict[tuple, Event] = {}
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.upstream_fetches = 0
+        self._lock = Lock()
+
+    def _http_fetch(self, url: str) -> tuple[bytes, str, str]:
+        started = time.monotonic()
+        req = urllib.request.Request(url, headers={'User-Agent': self.USER_AGENT})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            chunks = []
+            while True:
+                # A slow origin trickling bytes would otherwise never hit the socket timeout
+                if time.monotonic() - started > self.deadline:
+                    raise TimeoutError(f"download exceeded {self.deadline}s")
+                chunk = resp.read1(self.READ_CHUNK)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks), resp.headers.get('Content-Type', ''), resp.geturl()
+
+    @staticmethod
+    def channel_id(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()[:10]
+
+    def register_channel(self, url: str) -> str:
+        """Make an upstream channel playlist available under /hls/<id>/index.m3u8."""
+        channel_id = self.channel_id(url)
+        with self._lock:
+            if channel_id not in self._channels:
+                self._channels[channel_id] = {'url': url, 'last_access': 0.0, 'resources': OrderedDict()}
+        return channel_id
+
+    def rewrite_channel_list(self, text: str) -> str:
+        """Point every channel in an M3U channel list at its relay URL."""
+        lines = []
+        for line in text.splitlines():
+            stripped = line.strip()
+            if stripped and not stripped.startswith('#') and urlparse(stripped).scheme in ('http', 'https'):
+                line = f'/hls/{self.register_channel(stripped)}/index.m3u8'
+            lines.append(line)
+        return '\n'.join(lines) + '\n'
+
+    def _local_url(self, channel_id: str, url: str) -> str:
+        """Register an upstream resource for a channel and return its relay URL."""
+        ext = os.path.splitext(urlparse(url).path)[1].lower()
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + (ext if len(ext) <= 5 else '')
+        resources = self._channels[channel_id]['resources']
+        resources[key] = url
+        resources.move_to_end(key)
+        while len(resources) > self.MAX_RESOURCES:
+            resources.popitem(last=False)
+        return f'/hls/{channel_id}/{key}'
+
+    def _rewrite_playlist(self, channel_id: str, base_url: str, text: str) -> tuple[str, float]:
+        """Rewrite playlist URIs to relay URLs; returns the text and how long it stays fresh."""
+        target_duration = None
+        is_live = '#EXT-X-ENDLIST' not in text
+        lines = []
+        with self._lock:
+            for line in text.splitlines():
+                stripped = line.strip()
+                if stripped.startswith('#EXT-X-TARGETDURATION:'):
+                    try:
+                        target_duration = float(stripped.split(':', 1)[1])
+                    except ValueError:
+                        pass
+                if stripped and not stripped.startswith('#'):
+                    line = self._local_url(channel_id, urljoin(base_url, stripped))
+                elif 'URI="' in line:
+                    # EXT-X-KEY, EXT-X-MAP and EXT-X-MEDIA carry their URI as an attribute
+                    line = re.sub(
+                        r'URI="([^"]+)"',
+                        lambda m: f'URI="{self._local_url(channel_id, urljoin(base_url, m.group(1)))}"',
+                        line
+                    )
+                lines.append(line)
+
+        if target_duration is None:
+            # Master playlists list variants and rarely change
+            ttl = 30.0
+        elif is_live:
+            # Half a segment keeps displays at the live edge without re-fetching per viewer
+            ttl = max(1.0, target_duration / 2)
+        else:
+            ttl = 3600.0
+        return '\n'.join(lines) + '\n', ttl
+
+    @property
+    def sweep_interval(self) -> float:
+        return min(10, self.idle_seconds)
+
+    def _sweep(self, now: float) -> None:
+        """Drop cached data of channels nobody has requested recently. Call with the lock held."""
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        idle = {
+            channel_id for channel_id, channel in self._channels.items()
+            if now - channel['last_access'] > self.idle_seconds
+        }
+        for channel_id in idle:
+            cached = [k for k in self._cache if k[0] == channel_id]
+            if self._channels[channel_id]['resources'] or cached:
+                self._channels[channel_id]['resources'].clear()
+                for cache_key in cached:
+                    self._cache_bytes -= len(self._cache.pop(cache_key)[1])
+                logger.info("Dropped idle live TV channel %s", channel_id)
+
+    def sweep(self) -> None:
+        """Drop idle channels without waiting for the next request."""
+        with self._lock:
+            self._sweep(time.monotonic())
+
+    def _store(self, cache_key: tuple, expires_at: float, body: bytes, content_type: str) -> None:
+        """Add an entry, evicting the oldest ones beyond the byte budget. Call with the lock held."""
+        old = self._cache.pop(cache_key, None)
+        if old is not None:
+            self._cache_bytes -= len(old[1])
+        self._cache[cache_key] = (expires_at, body, content_type)
+        self._cache_bytes += len(body)
+        while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted[1])
+
+    def get(self, channel_id: str, key: str) -> tuple[bytes, str]:
+        """
+        Return (body, content_type) for a channel resource, fetching it upstream
+        at most once at a time. Raises HlsUnknownResourceError for unknown
+        channels/resources.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            channel = self._channels.get(channel_id)
+            url = None
+            if channel is not None:
+                url = channel['url'] if key == 'index.m3u8' else channel['resources'].get(key)
+            if url is None:
+                raise HlsUnknownResourceError(f"{channel_id}/{key}")
+            channel['last_access'] = now
+
+        cache_key = (channel_id, key)
+        while True:
+            with self._lock:
+                entry = self._cache.get(cache_key)
+                if entry is not None and entry[0] > now:
+                    self._cache.move_to_end(cache_key)
+                    self.hits += 1
+                    return entry[1], entry[2]
+
+                pending = self._pending.get(cache_key)
+                if pending is None:
+                    self._pending[cache_key] = Event()
+                    self.upstream_fetches += 1
+                    break
+
+            # Another request is already fetching this resource; wait for its result.
+            # The fetch can overrun its deadline by one blocked read of up to `timeout`.
+            if not pending.wait(self.deadline + self.timeout):
+                raise HlsRelayError(f"Timed out waiting for {url}")
+            now = time.monotonic()
+            with self._lock:
+                if cache_key not in self._cache:
+                    raise HlsRelayError(f"Upstream fetch failed for {url}")
+
+        try:
+            try:
+                body, content_type, final_url = self._fetch(url)
+            except Exception as e:
+                raise HlsRelayError(f"Failed to fetch {url}: {e}") from e
+
+            is_playlist = key.endswith('.m3u8') or body.lstrip().startswith(b'#EXTM3U')
+            if is_playlist:
+                text, ttl = self._rewrite_playlist(channel_id, final_url, body.decode('utf-8', 'replace'))
+                body, content_type = text.encode('utf-8'), self.PLAYLIST_TYPE
+            else:
+                # Segments never change; they just age out of the rolling cache
+                ttl = float(self.idle_seconds)
+
+            with self._lock:
+                self._store(cache_key, time.monotonic() + ttl, body, content_type)
+            return body, content_type
+        finally:
+            with self._lock:
+                self._pending.pop(cache_key).set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "active_channels": sum(
+                    1 for c in self._channels.values()
+                    if c['resources'] and now - c['last_access'] <= self.idle_seconds
+                ),
+                "cache_bytes": self._cache_bytes,
+                "cache_entries": len(self._cache),
+                "hits": self.hits,
+                "upstream_fetches": self.upstream_fetches
+            }
+
+hls_relay = HlsRelay(config.HLS_CACHE_MB * 1024 * 1024, config.HLS_IDLE_SECONDS, config.HLS_UPSTREAM_TIMEOUT)
+
+def sweep_hls_relay() -> None:
+    """Free idle channels even when every display has stopped requesting live TV."""
+    while True:
+        socketio.sleep(hls_relay.sweep_interval)
+        try:
+            hls_relay.sweep()
+        except Exception as e:
+            logger.error("Live TV relay sweep failed: %s", e)
+
+if config.HLS_RELAY_ENABLED:
+    socketio.start_background_task(sweep_hls_relay)
+
+def read_channel_list() -> str:
+    """Read the display's channel list, pointed at the relay when it is enabled."""
+    with open(config.HLS_CHANNEL_LIST, 'r', encoding='utf-8') as f:
+        text = f.read()
+    return hls_relay.rewrite_channel_list(text) if config.HLS_RELAY_ENABLED else text
+
+# Register channels up front so displays that cached the list keep working across restarts
+try:
+    read_channel_list()
+except OSError as e:
+    logger.warning("Could not read live TV channel list %s: %s", config.HLS_CHANNEL_LIST, e)
+
+# --- Static Asset Pipeline ---
+def minify_css(css: str) -> str:
+    """Strip comments and collapse whitespace around CSS punctuation."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    return re.sub(r'\s*([{};,>])\s*', r'\1', css).strip()
+
+def minify_js(js: str) -> str:
+    """Strip indentation and blank lines; line breaks are kept so ASI still applies."""
+    return '\n'.join(line.strip() for line in js.splitlines() if line.strip())
+
+class AssetPipeline:
+    """
+    Startup build step for the page templates and the files they load.
+
+    Inline <style>/<script> blocks are pulled out into minified files, every
+    asset gets a content-hashed URL under /assets/ with gzip/brotli copies,
+    large images are downscaled, and each page shell is rendered once and
+    served with an ETag.
+    """
+    COMPRESSIBLE = ('.js', '.css', '.html', '.json', '.svg', '.m3u8', '.ico')
+    IMAGE_MAX_SIZE = 512
+
+    def __init__(self, build_folder: str):
+        self.build_folder = build_folder
+        # Fingerprinted name -> path of the file to serve
+        self.assets: Dict[str, str] = {}
+        # Original URL -> fingerprinted /assets/ URL
+        self.urls: Dict[str, str] = {}
+        # Template name -> {'etag', 'identity', 'gzip', 'br'}
+        self.pages: Dict[str, Dict[str, Any]] = {}
+        # /public/ file name -> optimized copy (URLs there are fixed by the PWA)
+        self.public_files: Dict[str, str] = {}
+
+    @staticmethod
+    def fingerprint(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()[:12]
+
+    def _compress(self, path: str, content: bytes) -> None:
+        """Write .gz/.br siblings for path, reusing them if already built."""
+        if not os.path.exists(path + '.gz'):
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None and not os.path.exists(path + '.br'):
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(content, quality=11))
+
+    def _add_content(self, filename: str, content: bytes, source_path: Optional[str] = None) -> str:
+        """Register content under a fingerprinted name and return its URL."""
+        stem, ext = os.path.splitext(filename)
+        name = f"{stem}.{self.fingerprint(content)}{ext}"
+        build_path = os.path.join(self.build_folder, name)
+
+        if source_path is None:
+            if not os.path.exists(build_path):
+                with open(build_path, 'wb') as f:
+                    f.write(content)
+            source_path = build_path
+        self.assets[name] = source_path
+
+        if ext.lower() in self.COMPRESSIBLE:
+            self._compress(build_path, content)
+        return f'/assets/{name}'
+
+    def _optimize_image(self, path: str) -> bytes:
+        """Downscale an image to IMAGE_MAX_SIZE, keeping the original if that isn't smaller."""
+        with open(path, 'rb') as f:
+            original = f.read()
+        if Image is None:
+            return original
+
+        try:
+            with Image.open(BytesIO(original)) as im:
+                im.thumbnail((self.IMAGE_MAX_SIZE, self.IMAGE_MAX_SIZE))
+                out = BytesIO()
+                im.save(out, format=im.format or 'PNG', optimize=True)
+            optimized = out.getvalue()
+            return optimized if len(optimized) < len(original) else original
+        except Exception as e:
+            logger.warning("Could not optimize image %s: %s", path, e)
+            return original
+
+    def add_static_url(self, url: str) -> str:
+        """Fingerprint a /static/ file, returning its /assets/ URL (or the URL unchanged)."""
+        if url in self.urls:
+            return self.urls[url]
+
+        path = url.lstrip('/')
+        if not os.path.isfile(path):
+            return url
+
+        filename = os.path.basename(path)
+        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+            fingerprinted = self._add_content(filename, self._optimize_image(path))
+        else:
+            with open(path, 'rb') as f:
+                fingerprinted = self._add_content(filename, f.read(), source_path=path)
+        self.urls[url] = fingerprinted
+        return fingerprinted
+
+    def _build_page(self, template: str) -> None:
+        with open(os.path.join(app.template_folder, template), 'r', encoding='utf-8') as f:
+            source = f.read()
+        page = os.path.splitext(template)[0]
+
+        def extract_style(match) -> str:
+            url = self._add_content(f'{page}.css', minify_css(match.group(1)).encode('utf-8'))
+            return f'<link rel="stylesheet" href="{url}">'
+
+        script_count = 0
+        def extract_script(match) -> str:
+            nonlocal script_count
+            script_count += 1
+            url = self._add_content(f'{page}-{script_count}.js', minify_js(match.group(1)).encode('utf-8'))
+            return f'<script src="{url}"></script>'
+
+        source = re.sub(r'<style>(.*?)</style>', extract_style, source, flags=re.S)
+        source = re.sub(r'<script>(.*?)</script>', extract_script, source, flags=re.S)
+        source = re.sub(
+            r'((?:src|href)=")(/static/[^"]+)(")',
+            lambda m: m.group(1) + self.add_static_url(m.group(2)) + m.group(3),
+            source
+        )
+
+        body = app.jinja_env.from_string(source).render().encode('utf-8')
+        entry = {'etag': self.fingerprint(body), 'identity': body, 'gzip': gzip.compress(body, mtime=0)}
+        if brotli is not None:
+            entry['br'] = brotli.compress(body)
+        self.pages[template] = entry
+
+    def build(self, templates: List[str], public_images: List[str]) -> None:
+        """Build all pages and optimized public images, pruning stale build output."""
+        os.makedirs(self.build_folder, exist_ok=True)
+        for template in templates:
+            self._build_page(template)
+
+        for filename in public_images:
+            path = os.path.join('public', filename)
+            if os.path.isfile(path):
+                url = self._add_content(filename, self._optimize_image(path))
+                self.public_files[filename] = self.assets[url.rsplit('/', 1)[1]]
+
+        keep = set()
+        for name, path in self.assets.items():
+            keep.update({name, name + '.gz', name + '.br'})
+        for name in os.listdir(self.build_folder):
+            if name not in keep:
+                os.remove(os.path.join(self.build_folder, name))
+
+        logger.info("Built %d pages and %d fingerprinted assets", len(self.pages), len(self.assets))
+
+asset_pipeline = AssetPipeline(config.ASSET_BUILD_FOLDER)
+try:
+    asset_pipeline.build(
+        ['staff.html', 'display.html', 'dashboard.html'],
+        ['icon.png', 'logo.png']
+    )
+except Exception as e:
+    # Pages fall back to render_template and files to send_from_directory
+    logger.error("Failed to build static assets: %s", e)
+
 # --- Helper Functions ---
 def validate_call_data(data: Dict[str, Any]) -> tuple[Optional[str], Optional[str], Optional[str]]:
     """Validate and extract call data."""
@@ -313,30 +1294,31 @@ def sync_to_cloud(number: str, counter: str) -> None:
             'timestamp': timestamp.isoformat()
         })
 
-        logger.info(f"Successfully mirrored call {number} to Firebase")
+        logger.info("Successfully mirrored call %s to Firebase", number)
     except Exception as e:
-        logger.error(f"Failed to sync to Firebase: {e}")
+        logger.error("Failed to sync to Firebase: %s", e)
         
 def cleanup_old_firebase_data() -> None:
-    """Delete history from previous days to save space."""
+    """Delete history (and lookahead push records) from previous days to save space."""
     try:
-        ref = db.reference('qms/locations/LOC_1/history')
-        # Use shallow=True to get only keys (dates) without fetching all data
-        dates = ref.get(shallow=True)
-        
-        if not dates:
-            return
-
         today = datetime.now().strftime('%Y-%m-%d')
         deleted_count = 0
 
-        for date_str in dates:
-            if date_str < today:
-                ref.child(date_str).delete()
-                deleted_count += 1
+        for node in ('history', 'notified'):
+            ref = db.reference(f'qms/locations/LOC_1/{node}')
+            # Use shallow=True to get only keys (dates) without fetching all data
+            dates = ref.get(shallow=True)
+            
+            if not dates:
+                continue
+
+            for date_str in dates:
+                if date_str < today:
+                    ref.child(date_str).delete()
+                    deleted_count += 1
                 
         if deleted_count > 0:
-            logger.info(f"Cleaned up {deleted_count} old days of history from Firebase")
+            logger.info(f"Cleaned up {deleted_count} old days of history and push records from Firebase")
             
     except Exception as e:
         logger.error(f"Error during Firebase cleanup: {e}")
@@ -350,96 +1332,318 @@ def cleanup_stale_tokens():
         logger.error(f"Failed to clear tokens: {e}")
 
 
-def send_push_notification(number: str, counter: str) -> None:
-    """Send FCM push notification to the specific device for this number."""
-    try:
-        # Look up the token in fcm_tokens/LOC_1/{number}
-        token_ref = db.reference(f'fcm_tokens/LOC_1/{number}')
-        token = token_ref.get()
+# --- Push Notification Dispatcher ---
+def extract_fcm_token(number: str, record: Any) -> Optional[str]:
+    """Pull the FCM token out of a fcm_tokens/LOC_1/{number} record, if it has one."""
+    if not record:
+        return None
 
-        if not token:
-            logger.info(f"No FCM token found for number {number}, skipping push.")
-            return
+    # Handle if token is a dictionary (common if stored with metadata)
+    if isinstance(record, dict):
+        record = record.get('token')
+        if not record:
+            logger.info("Token dictionary does not contain 'token' key for %s.", number)
+            return None
 
-        # Debugging: Log the token type and content
-        logger.info(f"Fetched token data for {number}: {token} (type: {type(token)})")
+    # Ensure token is a string
+    if not isinstance(record, str) or not record.strip():
+        logger.warning("Invalid token format for %s (type: %s)", number, type(record).__name__)
+        return None
+    return record
 
-        # Handle if token is a dictionary (common if stored with metadata)
-        if isinstance(token, dict):
-            token = token.get('token')
-            if not token:
-                logger.info(f"Token dictionary does not contain 'token' key for {number}.")
-                return
-        
-        # Ensure token is a string
-        if not isinstance(token, str) or not token.strip():
-             logger.warning(f"Invalid token format for {number}: {token}")
-             return
-
-        # Create the message
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title='Farmasi',
-                body=f'Nombor {number} sila ke Kaunter {counter}',
-            ),
-            webpush=messaging.WebpushConfig(
-                fcm_options=messaging.WebpushFCMOptions(
-                    link='https://qms-hybrid.firebaseapp.com'
-                ),
-                notification=messaging.WebpushNotification(
-                    tag='qms-notification', # This is the magic key to prevent duplicates
-                    renotify=True
-                )
+def build_push_message(token: str, body: str) -> messaging.Message:
+    return messaging.Message(
+        notification=messaging.Notification(
+            title='Farmasi',
+            body=body,
+        ),
+        webpush=messaging.WebpushConfig(
+            fcm_options=messaging.WebpushFCMOptions(
+                link='https://qms-hybrid.firebaseapp.com'
             ),
-            token=token,
-        )
+            notification=messaging.WebpushNotification(
+                tag='qms-notification', # This is the magic key to prevent duplicates
+                renotify=True
+            )
+        ),
+        token=token,
+    )
 
-        # Send the message
-        response = messaging.send(message)
-        logger.info(f"Successfully sent push notification to {number}: {response}")
+def lookahead_numbers(number: str, count: int) -> List[str]:
+    """The `count` numbers after `number`, keeping any prefix and zero padding ("A007" -> "A008", ...)."""
+    match = re.fullmatch(r'(\D*)(\d+)', number)
+    if not match:
+        return []
+    prefix, digits = match.groups()
+    return [f"{prefix}{str(int(digits) + offset).zfill(len(digits))}" for offset in range(1, count + 1)]
 
-    except Exception as e:
-        logger.error(f"Failed to send push notification: {e}")
+def fetch_fcm_tokens(numbers: List[str]) -> Dict[str, Any]:
+    """Fetch token records for several numbers, in one query when their keys sort contiguously."""
+    ref = db.reference('fcm_tokens/LOC_1')
+    wanted = set(numbers)
+    if len({len(n) for n in numbers}) == 1:
+        # Same-width keys: the numeric range is also a key range
+        records = ref.order_by_key().start_at(min(numbers)).end_at(max(numbers)).get() or {}
+        return {n: record for n, record in records.items() if n in wanted}
+    return {n: ref.child(n).get() for n in numbers}
+
+def called_numbers_on(day: str) -> List[str]:
+    """Numbers already called on a date, from the call log."""
+    return [call['number'] for call in csv_logger.get_calls_by_date(day)]
+
+def fetch_warned_numbers(day: str) -> List[str]:
+    """Numbers that already got their lookahead push on a date."""
+    # shallow=True returns only the keys (numbers)
+    return list(db.reference(f'qms/locations/LOC_1/notified/{day}').get(shallow=True) or {})
+
+def record_warned_numbers(day: str, numbers: List[str]) -> None:
+    """Remember lookahead pushes across restarts in a per-day Firebase node."""
+    db.reference(f'qms/locations/LOC_1/notified/{day}').update({n: True for n in numbers})
+
+class NotificationDispatcher:
+    """
+    Sends the push for a called number together with "almost your turn"
+    pushes for the next `lookahead` numbers as one batched FCM request.
+
+    Each number gets at most one lookahead push per day, and none once it
+    has been called. Both sets are reloaded for the day (called numbers from
+    the call log, warned numbers from Firebase) so a restart does not notify
+    anyone twice. Token lookup, sending and that state are injectable so a
+    local stand-in can replace Firebase.
+    """
+    def __init__(self, lookahead: int,
+                 fetch_tokens: Callable[[List[str]], Dict[str, Any]] = fetch_fcm_tokens,
+                 send_each: Optional[Callable[[List[messaging.Message]], Any]] = None,
+                 load_called: Callable[[str], List[str]] = called_numbers_on,
+                 load_warned: Callable[[str], List[str]] = fetch_warned_numbers,
+                 save_warned: Callable[[str, List[str]], None] = record_warned_numbers):
+        self.lookahead = lookahead
+        self._fetch_tokens = fetch_tokens
+        # messaging.send_each reuses the app's HTTP session for every message in the batch
+        self._send_each = send_each or messaging.send_each
+        self._load_called = load_called
+        self._load_warned = load_warned
+        self._save_warned = save_warned
+        self._day = None
+        self._called: set = set()
+        self._warned: set = set()
+        self._lock = Lock()
+
+    def _reset_if_new_day(self) -> None:
+        """Load the day's called/warned numbers on first use and at each date change. Call with the lock held."""
+        today = datetime.now().strftime('%Y-%m-%d')
+        if self._day != today:
+            self._day = today
+            self._called.clear()
+            self._warned.clear()
+            try:
+                self._called.update(self._load_called(today))
+            except Exception as e:
+                logger.error("Failed to load called numbers for %s: %s", today, e)
+            try:
+                self._warned.update(self._load_warned(today))
+            except Exception as e:
+                logger.error("Failed to load notified numbers for %s: %s", today, e)
+
+    def dispatch(self, number: str, counter: str) -> int:
+        """Notify the called number and upcoming numbers; returns how many pushes were sent."""
+        try:
+            with self._lock:
+                self._reset_if_new_day()
+                self._called.add(number)
+                upcoming = [
+                    n for n in lookahead_numbers(number, self.lookahead)
+                    if n not in self._called and n not in self._warned
+                ]
+
+            records = self._fetch_tokens([number] + upcoming)
+
+            messages = []
+            recipients = []
+            token = extract_fcm_token(number, records.get(number))
+            if token:
+                messages.append(build_push_message(token, f'Nombor {number} sila ke Kaunter {counter}'))
+                recipients.append(number)
+            else:
+                logger.info("No FCM token found for number %s, skipping push.", number)
+
+            for position, upcoming_number in enumerate(upcoming, start=1):
+                token = extract_fcm_token(upcoming_number, records.get(upcoming_number))
+                if token:
+                    messages.append(build_push_message(
+                        token,
+                        f'Nombor {upcoming_number} hampir dipanggil ({position} nombor lagi). Sila bersedia.'
+                    ))
+                    recipients.append(upcoming_number)
+
+            if not messages:
+                return 0
+
+            batch = self._send_each(messages)
+            sent = 0
+            warned = []
+            with self._lock:
+                day = self._day
+                for recipient, response in zip(recipients, batch.responses):
+                    if response.success:
+                        sent += 1
+                        if recipient != number:
+                            self._warned.add(recipient)
+                            warned.append(recipient)
+                    else:
+                        logger.warning("Push notification to %s failed: %s", recipient, response.exception)
+
+            if warned:
+                try:
+                    self._save_warned(day, warned)
+                except Exception as e:
+                    logger.error("Failed to record notified numbers: %s", e)
+
+            logger.info("Sent %d of %d push notifications for call %s", sent, len(messages), number)
+            return sent
+
+        except Exception as e:
+            logger.error("Failed to send push notification: %s", e)
+            return 0
+
+notification_dispatcher = NotificationDispatcher(config.NOTIFY_LOOKAHEAD)
+
+# --- Broadcasting ---
+def engineio_socket(sid: str) -> tuple[Optional[str], Any]:
+    """The engine.io session id and socket behind a Socket.IO sid, if still open."""
+    eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+    return eio_sid, socketio.server.eio.sockets.get(eio_sid)
+
+def outbound_backlog(sid: str) -> int:
+    """Packets queued for a client that its transport has not written yet."""
+    try:
+        _, eio_socket = engineio_socket(sid)
+        return eio_socket.queue.qsize() if eio_socket else 0
+    except Exception:
+        return 0
+
+def close_transport(sid: str) -> None:
+    """
+    Drop a client's unsent backlog and close its engine.io connection.
+    Leaving the namespace alone would queue the DISCONNECT behind that backlog.
+    The disconnect handler does the registry bookkeeping.
+    """
+    eio_sid, eio_socket = engineio_socket(sid)
+    if eio_socket is None:
+        return
+    queue_empty = socketio.server.eio.get_queue_empty_exception()
+    try:
+        while True:
+            eio_socket.queue.get(block=False)
+            eio_socket.queue.task_done()
+    except queue_empty:
+        pass
+    # Closing waits for the writer to flush the CLOSE packet; keep that off the broadcast path
+    socketio.start_background_task(socketio.server.eio.disconnect, eio_sid)
+
+def broadcast_state(state: Dict[str, Any]) -> None:
+    """
+    Emit a queue state to all clients, sparing the broadcast from slow consumers.
+    Clients with a backlog above SOCKET_DROP_BACKLOG skip this state (each state
+    is a full snapshot); above SOCKET_EVICT_BACKLOG they are disconnected.
+    """
+    skipped = []
+    for sid in client_registry.sids():
+        backlog = outbound_backlog(sid)
+        if backlog > config.SOCKET_EVICT_BACKLOG:
+            logger.warning("Evicting slow client %s (%d packets queued)", sid, backlog)
+            client_registry.record_evict()
+            skipped.append(sid)
+            try:
+                close_transport(sid)
+            except Exception as e:
+                logger.error("Failed to evict client %s: %s", sid, e)
+        elif backlog > config.SOCKET_DROP_BACKLOG:
+            client_registry.record_drop()
+            skipped.append(sid)
+
+    socketio.emit("current_state", state, skip_sid=skipped or None)
 
 def update_and_broadcast_call(number: str, counter: str) -> None:
-    
-    
-    
     """
     Central function to handle a new call.
     Updates history, logs to CSV, and emits events to all clients.
+    Every log record emitted while handling the call shares one call_id.
     """
+    call_id_token = call_id_var.set(uuid.uuid4().hex[:12])
     try:
         call_manager.add_call(number, counter)
         current_state = call_manager.get_current_state()
-        socketio.emit("current_state", current_state)
+        broadcast_state(current_state)
         
         # Sync to Cloud
         sync_to_cloud(number, counter)
         
-        # Send Push Notification
-        send_push_notification(number, counter)
+        # Send Push Notifications (called number plus lookahead window)
+        notification_dispatcher.dispatch(number, counter)
         
-        logger.info(f"Broadcasted call update: {number} at {counter}")
+        logger.info("Broadcasted call update: %s at %s", number, counter)
     except Exception as e:
-        logger.error(f"Error updating and broadcasting call: {e}")
+        logger.error("Error updating and broadcasting call: %s", e)
         raise
+    finally:
+        call_id_var.reset(call_id_token)
+
+def send_precompressed(path: str, filename: str, cache_control: str) -> flask.Response:
+    """Send a file, preferring a prebuilt .br/.gz copy the client accepts."""
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        variant = os.path.join(asset_pipeline.build_folder, filename + suffix)
+        if candidate in request.accept_encodings and os.path.exists(variant):
+            path, encoding = variant, candidate
+            break
+
+    response = flask.send_file(os.path.abspath(path), mimetype=mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def serve_page(template: str) -> flask.Response:
+    """Serve a prebuilt page shell with an ETag, or render it if the build failed."""
+    page = asset_pipeline.pages.get(template)
+    if page is None:
+        return render_template(template)
+
+    encoding = next((e for e in ('br', 'gzip') if e in page and e in request.accept_encodings), None)
+    response = flask.make_response(page[encoding or 'identity'])
+    response.mimetype = 'text/html'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Shells are tiny once assets are external; always revalidate so new builds show up
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{page['etag']}-{encoding or 'identity'}")
+    return response.make_conditional(request)
 
 # --- SocketIO Event Handlers ---
 @socketio.on("connect")
 def handle_connect():
-    """Send current state to newly connected clients."""
+    """Admit the client if its role has room, then send it the current state."""
+    role = client_registry.normalize_role(request.args.get('role'))
+    if not client_registry.admit(request.sid, role):
+        logger.warning("Rejected %s client: limit of %d reached", role, client_registry.limits[role])
+        raise ConnectionRefusedError(f"Too many {role} clients connected")
+
     try:
         current_state = call_manager.get_current_state()
         emit("current_state", current_state)
-        logger.info("Client connected and received current state")
+        logger.info("Client connected (%s) and received current state", role)
     except Exception as e:
-        logger.error(f"Error handling client connection: {e}")
+        logger.error("Error handling client connection: %s", e)
 
 @socketio.on("disconnect")
-def handle_disconnect():
+def handle_disconnect(reason=None):
     """Handle client disconnection."""
-    logger.info("Client disconnected")
+    role = client_registry.remove(request.sid)
+    logger.info("Client disconnected (%s)", role)
 
 @socketio.on("call_number")
 def handle_call_event(data):
@@ -459,12 +1663,12 @@ def handle_call_event(data):
 @app.route("/")
 def index():
     """Serve the staff page."""
-    return render_template("staff.html")
+    return serve_page("staff.html")
 
 @app.route("/display")
 def display():
     """Serve the display page."""
-    return render_template("display.html")
+    return serve_page("display.html")
 
 @app.route("/display2")
 def display2():
@@ -474,23 +1678,78 @@ def display2():
 @app.route("/dashboard")
 def dashboard():
     """Serve the dashboard page."""
-    return render_template("dashboard.html")
+    return serve_page("dashboard.html")
 
 # --- Temporary Portal Hosting ---
 @app.route("/portal")
 def patient_portal():
     """Serve the patient portal (public/index.html)."""
-    return flask.send_from_directory('public', 'index.html')
+    response = flask.send_from_directory('public', 'index.html')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route("/public/<path:filename>")
 def public_files(filename):
     """Serve static files for the portal (js, sw, etc)."""
-    return flask.send_from_directory('public', filename)
+    # Portal URLs aren't fingerprinted, so cache briefly and revalidate by ETag
+    if filename in asset_pipeline.public_files:
+        return send_precompressed(asset_pipeline.public_files[filename], filename, 'public, max-age=3600')
+    return flask.send_from_directory('public', filename, max_age=3600)
 
 @app.route("/firebase-messaging-sw.js")
 def service_worker():
     """Serve service worker from public root."""
-    return flask.send_from_directory('public', 'firebase-messaging-sw.js')
+    # Browsers must always see a new service worker as soon as it is deployed
+    response = flask.send_from_directory('public', 'firebase-messaging-sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route("/display-sw.js")
+def display_service_worker():
+    """Serve the display service worker from the root so it can control /display."""
+    response = flask.send_from_directory('static/js', 'display-sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route("/hls/channels.m3u8")
+def hls_channel_list():
+    """Serve the live TV channel list for the display."""
+    try:
+        response = flask.make_response(read_channel_list())
+        response.mimetype = 'audio/x-mpegurl'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except OSError as e:
+        logger.error("Error reading channel list: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Failed to read channel list"
+        }), 500
+
+@app.route("/hls/<channel_id>/<key>")
+def hls_relay_resource(channel_id, key):
+    """Serve a relayed live TV playlist or segment."""
+    try:
+        body, content_type = hls_relay.get(channel_id, key)
+    except HlsUnknownResourceError:
+        return jsonify({"status": "error", "message": "Unknown channel or segment"}), 404
+    except HlsRelayError as e:
+        logger.warning("Live TV relay error: %s", e)
+        return jsonify({"status": "error", "message": "Upstream stream unavailable"}), 502
+
+    response = flask.make_response(body)
+    response.headers['Content-Type'] = content_type or 'application/octet-stream'
+    # Playlists move with the live edge; segments never change
+    response.headers['Cache-Control'] = 'no-cache' if content_type == HlsRelay.PLAYLIST_TYPE else 'public, max-age=60'
+    return response
+
+@app.route("/assets/<path:filename>")
+def fingerprinted_asset(filename):
+    """Serve a fingerprinted asset; its URL changes whenever its content does."""
+    path = asset_pipeline.assets.get(filename)
+    if path is None:
+        flask.abort(404)
+    return send_precompressed(path, filename, 'public, max-age=31536000, immutable')
 
 
 @app.route("/health")
@@ -500,7 +1759,10 @@ def health_check():
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "calls_in_history": len(call_manager.call_history),
-        "csv_logging": "enabled"
+        "csv_logging": "enabled",
+        "log_records_dropped": log_handler.dropped,
+        "socket_clients": client_registry.stats(),
+        "hls_relay": hls_relay.stats()
     })
 
 @app.route("/api/call_number", methods=["POST"])
@@ -574,6 +1836,7 @@ def restart_server():
             import time
             time.sleep(1)
             logger.warning("Restarting process now...")
+            flush_logging()  # os._exit skips atexit handlers
             # Exit with status 1 to trigger restart in the batch file loop or systemd
             os._exit(1)
             
@@ -639,6 +1902,7 @@ def perform_update():
             import time
             time.sleep(1)
             logger.warning("Restarting process post-update now...")
+            flush_logging()
             os._exit(1)
             
         from threading import Thread
@@ -697,7 +1961,8 @@ def get_logs_by_date(date):
         # Validate date format
         datetime.strptime(date, '%Y-%m-%d')
         
-        date_calls = csv_logger.get_calls_by_date(date)
+        # Closed months live in the columnar archive once compacted
+        date_calls = call_archive.get_calls_by_date(date) + csv_logger.get_calls_by_date(date)
         return jsonify({
             "status": "success",
             "data": date_calls,
@@ -754,6 +2019,102 @@ def get_logs_stats():
             "message": "Failed to retrieve logs statistics"
         }), 500
 
+# --- Analytics API Endpoints ---
+def parse_month_range() -> tuple[str, str]:
+    """Read ?from=YYYY-MM&to=YYYY-MM, defaulting to all history up to this month."""
+    # Archive timestamps count from 1970, so that is the earliest possible month
+    start_month = request.args.get('from', '1970-01')
+    end_month = request.args.get('to', datetime.now().strftime('%Y-%m'))
+    for month in (start_month, end_month):
+        # Months are compared as strings, so they must be zero-padded
+        if not re.fullmatch(r'\d{4}-\d{2}', month):
+            raise ValueError(f"Invalid month: {month}")
+        datetime.strptime(month, '%Y-%m')
+    return start_month, end_month
+
+@app.route('/api/analytics/heatmap')
+def get_analytics_heatmap():
+    """Call counts by weekday (Monday first) and hour of day."""
+    try:
+        start_month, end_month = parse_month_range()
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "Invalid month format. Use YYYY-MM"
+        }), 400
+
+    try:
+        matrix = call_archive.heatmap(start_month, end_month, csv_logger.get_all_calls())
+        return jsonify({
+            "status": "success",
+            "data": {
+                "days": CallArchive.DAY_NAMES,
+                "hours": list(range(24)),
+                "counts": matrix
+            },
+            "from": start_month,
+            "to": end_month
+        })
+    except Exception as e:
+        logger.error("Error building heatmap: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Failed to build heatmap"
+        }), 500
+
+@app.route('/api/analytics/monthly')
+def get_analytics_monthly():
+    """Monthly totals and counter usage, plus a year-over-year view."""
+    try:
+        start_month, end_month = parse_month_range()
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "Invalid month format. Use YYYY-MM"
+        }), 400
+
+    try:
+        months = call_archive.monthly_totals(start_month, end_month, csv_logger.get_all_calls())
+
+        # years[YYYY][month_index] = total calls, for year-over-year charts
+        years: Dict[str, List[int]] = {}
+        for month, summary in months.items():
+            year, month_number = month.split('-')
+            years.setdefault(year, [0] * 12)[int(month_number) - 1] = summary['total_calls']
+
+        return jsonify({
+            "status": "success",
+            "data": {
+                "months": months,
+                "years": years
+            },
+            "from": start_month,
+            "to": end_month
+        })
+    except Exception as e:
+        logger.error("Error building monthly totals: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Failed to build monthly totals"
+        }), 500
+
+@app.route('/api/analytics/compact', methods=['POST'])
+def compact_call_logs():
+    """Roll closed months out of the live CSV into the columnar archive."""
+    try:
+        archived = csv_logger.archive_closed_months(call_archive, datetime.now().strftime('%Y-%m'))
+        return jsonify({
+            "status": "success",
+            "archived_calls": archived,
+            "archived_months": call_archive.months()
+        })
+    except Exception as e:
+        logger.error("Error compacting call logs: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Failed to compact call logs"
+        }), 500
+
 # --- Error Handlers ---
 @app.errorhandler(404)
 def not_found(error):
@@ -766,13 +2127,13 @@ def internal_error(error):
 
 # --- Main Execution ---
 if __name__ == "__main__":
-    logger.info(f"Starting application on {config.HOST}:{config.PORT}")
-    logger.info(f"Debug mode: {config.DEBUG}")
-    logger.info(f"CSV logging enabled - logs will be saved to: {csv_logger.csv_path}")
-    logger.info(f"Available routes:")
-    logger.info(f"  Staff Interface: http://{config.HOST}:{config.PORT}/")
-    logger.info(f"  Display Page: http://{config.HOST}:{config.PORT}/display")
-    logger.info(f"  Dashboard: http://{config.HOST}:{config.PORT}/dashboard")
+    logger.info("Starting application on %s:%s", config.HOST, config.PORT)
+    logger.info("Debug mode: %s", config.DEBUG)
+    logger.info("CSV logging enabled - logs will be saved to: %s", csv_logger.csv_path)
+    logger.info("Available routes:")
+    logger.info("  Staff Interface: http://%s:%s/", config.HOST, config.PORT)
+    logger.info("  Display Page: http://%s:%s/display", config.HOST, config.PORT)
+    logger.info("  Dashboard: http://%s:%s/dashboard", config.HOST, config.PORT)
     
     # Run cleanup on startup
     cleanup_old_firebase_data()
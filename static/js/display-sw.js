@@ -0,0 +1,143 @@
+// Service worker for the queue display (/display).
+// Keeps the page shell, its scripts/styles, audio clips and the media playlist
+// cached so a TV can render immediately after a server restart or network blip.
+// The last known queue state itself is kept by the page in localStorage.
+
+const CACHE_NAME = 'qms-display-v2';
+
+const AUDIO_CLIPS = ['doorbell', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9',
+    'counter1', 'counter2', 'counter3', 'counter4', 'counter5']
+    .map(name => `/static/audio/${name}.mp3`);
+
+const PRECACHE_URLS = [
+    '/display',
+    '/static/favicon.ico',
+    '/hls/channels.m3u8',
+    '/api/media-list',
+    ...AUDIO_CLIPS
+];
+
+// Fresh copies preferred, cached copy used when the server is unreachable
+const NETWORK_FIRST = ['/hls/channels.m3u8', '/api/media-list', '/api/current_state'];
+
+// Navigations give up on the network after this long and render from cache
+const NETWORK_TIMEOUT_MS = 3000;
+
+self.addEventListener('install', (event) => {
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => Promise.all(PRECACHE_URLS.map(url =>
+                cache.add(url).catch(err => console.warn(`Precache failed for ${url}`, err))
+            )))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key !== CACHE_NAME).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+// The page reports the same-origin resources it loaded (fingerprinted /assets/
+// URLs change with every build), so they can be cached and old builds pruned.
+self.addEventListener('message', (event) => {
+    const data = event.data || {};
+    if (data.type !== 'cache-urls' || !Array.isArray(data.urls)) return;
+
+    event.waitUntil((async () => {
+        const cache = await caches.open(CACHE_NAME);
+        const wanted = new Set(data.urls.map(url => new URL(url, self.location.origin).pathname));
+
+        for (const request of await cache.keys()) {
+            const path = new URL(request.url).pathname;
+            if (path.startsWith('/assets/') && !wanted.has(path)) {
+                await cache.delete(request);
+            }
+        }
+        for (const path of wanted) {
+            if (!(await cache.match(path))) {
+                await cache.add(path).catch(err => console.warn(`Cache failed for ${path}`, err));
+            }
+        }
+    })());
+});
+
+function timeout(ms) {
+    return new Promise((_, reject) => setTimeout(() => reject(new Error('timeout')), ms));
+}
+
+async function networkFirst(request, cacheKey, timeoutMs) {
+    const cache = await caches.open(CACHE_NAME);
+    try {
+        const fetched = fetch(request);
+        const response = await (timeoutMs ? Promise.race([fetched, timeout(timeoutMs)]) : fetched);
+        // A reverse proxy answers 502/503 while the app restarts; treat that as offline
+        if (response.status >= 500) throw new Error(`HTTP ${response.status}`);
+        if (response.ok) {
+            cache.put(cacheKey, response.clone());
+        }
+        return response;
+    } catch (err) {
+        const cached = await cache.match(cacheKey);
+        if (cached) return cached;
+        throw err;
+    }
+}
+
+async function cacheFirst(request) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request);
+    if (cached) return cached;
+
+    const response = await fetch(request);
+    if (response.ok) {
+        cache.put(request, response.clone());
+    }
+    return response;
+}
+
+async function staleWhileRevalidate(request) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request);
+    const refresh = fetch(request).then(response => {
+        if (response.ok) {
+            cache.put(request, response.clone());
+        }
+        return response;
+    });
+
+    if (cached) {
+        refresh.catch(() => { });
+        return cached;
+    }
+    return refresh;
+}
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    // Live data stays live: sockets, video files (range requests) and relayed TV
+    if (url.pathname.startsWith('/socket.io') || url.pathname.startsWith('/static/media/')) return;
+    if (url.pathname.startsWith('/hls/') && !NETWORK_FIRST.includes(url.pathname)) return;
+
+    if (request.mode === 'navigate') {
+        // One cached shell serves /display, /display?kiosk=true, ...
+        if (url.pathname === '/display') {
+            event.respondWith(networkFirst(request, '/display', NETWORK_TIMEOUT_MS));
+        }
+    } else if (NETWORK_FIRST.includes(url.pathname)) {
+        event.respondWith(networkFirst(request, url.pathname));
+    } else if (url.pathname.startsWith('/assets/')) {
+        // Fingerprinted: a cached copy can never be out of date
+        event.respondWith(cacheFirst(request));
+    } else if (url.pathname.startsWith('/static/')) {
+        event.respondWith(staleWhileRevalidate(request));
+    }
+});